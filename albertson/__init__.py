@@ -1,3 +1,4 @@
 from .base import Counter, CounterPool
+from .heavy_hitters import HeavyHitterTracker
 
 VERSION = (0, 1, 7)
@@ -1,9 +1,16 @@
 from datetime import datetime
+import calendar
+import json
+import math
+import numbers
+import time
+import zlib
 
 import boto
 from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError
 
 ISO_FORMAT = '%Y-%m-%dT%H:%M:%S'
+DAY_SECONDS = 24 * 60 * 60
 
 
 class CounterPool(object):
@@ -18,8 +25,19 @@ class CounterPool(object):
     }
     read_units = 3
     write_units = 5
+    heavy_hitter_tracker = None
+    index_table_name = None
+    index_schema = {
+        'hash_key_name': 'bucket',
+        'hash_key_proto_value': 'S',
+        'range_key_name': 'counter_name',
+        'range_key_proto_value': 'S',
+    }
+    index_bucket_seconds = 3600
+    index_shards = 10
+    index_close_delay = 300
 
-    def __init__(self, aws_access_key=None, aws_secret_key=None, table_name=None, schema=None, read_units=None, write_units=None, auto_create_table=True, ):
+    def __init__(self, aws_access_key=None, aws_secret_key=None, table_name=None, schema=None, read_units=None, write_units=None, auto_create_table=True, heavy_hitter_tracker=None, index_table_name=None, index_bucket_seconds=None, index_shards=None, index_close_delay=None, ):
         """
         :aws_access_key:
             AWS Acccess Key ID with permissions to use DynamoDB
@@ -42,6 +60,23 @@ class CounterPool(object):
         :auto_create_table:
             Should Albertson create a dynamodb table if the provided
             `table_name` doesn't exist.
+        :heavy_hitter_tracker:
+            An optional `HeavyHitterTracker` that will be fed every counter
+            read and increment, so hot counters can be spotted before
+            DynamoDB starts throttling them.
+        :index_table_name:
+            An optional DynamoDB table used to index counters by the time
+            bucket they were last modified in.  Required for
+            `changed_since`; no index is kept when it isn't set.
+        :index_bucket_seconds:
+            Width, in seconds, of the `modified_on` time buckets kept in the
+            index table.
+        :index_shards:
+            Number of hash keys each index bucket is spread over.
+        :index_close_delay:
+            Seconds after a bucket ends before `changed_since` treats it as
+            closed, allowing for clock skew between hosts and index writes
+            still in flight.
         """
         self.conn = self.get_conn(aws_access_key, aws_secret_key)
         self.table_name = table_name or self.table_name
@@ -49,6 +84,17 @@ class CounterPool(object):
         self.read_units = read_units or self.read_units
         self.write_units = write_units or self.write_units
         self.auto_create_table = auto_create_table
+        self.heavy_hitter_tracker = heavy_hitter_tracker or self.heavy_hitter_tracker
+        self.index_table_name = index_table_name or self.index_table_name
+        self.index_bucket_seconds = index_bucket_seconds or self.index_bucket_seconds
+        self.index_shards = index_shards or self.index_shards
+
+        if index_close_delay is not None:
+            self.index_close_delay = index_close_delay
+
+        self._indexed_bucket = None
+        self._indexed_names = set()
+        self._marked_shards = set()
 
         super(CounterPool, self).__init__()
 
@@ -99,14 +145,14 @@ class CounterPool(object):
         '''
         return self.write_units
 
-    def create_table(self):
+    def build_table(self, table_name, schema):
         '''
-        Hook point for overriding how the CounterPool creates a new table
-        in DynamooDB
+        Creates a table in DynamoDB with the given name and schema and waits
+        for it to become active.
         '''
         table = self.conn.create_table(
-            name=self.get_table_name(),
-            schema=self.get_schema(),
+            name=table_name,
+            schema=schema,
             read_units=self.get_read_units(),
             write_units=self.get_write_units(),
         )
@@ -116,25 +162,267 @@ class CounterPool(object):
 
         return table
 
+    def load_table(self, table_name, create_func):
+        '''
+        Fetches a boto DynamoDB Table object by name, calling `create_func`
+        when the table doesn't exist and `auto_create_table` is set.
+        '''
+        try:
+            table = self.conn.get_table(table_name)
+        except boto.exception.DynamoDBResponseError:
+            if self.auto_create_table:
+                table = create_func()
+            else:
+                raise
+
+        return table
+
+    def create_table(self):
+        '''
+        Hook point for overriding how the CounterPool creates a new table
+        in DynamooDB
+        '''
+        return self.build_table(self.get_table_name(), self.get_schema())
+
     def get_table(self):
         '''
         Hook point for overriding how the CounterPool transforms table_name
         into a boto DynamoDB Table object.
         '''
-        if hasattr(self, '_table'):
-            table = self._table
-        else:
-            try:
-                table = self.conn.get_table(self.get_table_name())
-            except boto.exception.DynamoDBResponseError:
-                if self.auto_create_table:
-                    table = self.create_table()
-                else:
-                    raise
+        if not hasattr(self, '_table'):
+            self._table = self.load_table(self.get_table_name(), self.create_table)
 
-            self._table = table
+        return self._table
 
-        return table
+    def get_index_table_name(self):
+        '''
+        Hook point for overriding how the CounterPool determines the table
+        name to use for the modified_on index.  Returning None disables the
+        index.
+        '''
+        return self.index_table_name
+
+    def get_index_schema(self):
+        '''
+        Hook point for overriding how the CounterPool determines the schema
+        to be used when creating a missing index table.
+        '''
+        return self.conn.create_schema(**self.index_schema)
+
+    def create_index_table(self):
+        '''
+        Hook point for overriding how the CounterPool creates a new index
+        table in DynamoDB.
+        '''
+        return self.build_table(self.get_index_table_name(), self.get_index_schema())
+
+    def get_index_table(self):
+        '''
+        Hook point for overriding how the CounterPool transforms
+        index_table_name into a boto DynamoDB Table object.
+        '''
+        if not hasattr(self, '_index_table'):
+            self._index_table = self.load_table(self.get_index_table_name(), self.create_index_table)
+
+        return self._index_table
+
+    def get_bucket_start(self, timestamp):
+        '''
+        Returns the unix timestamp of the start of the index bucket that a
+        unix `timestamp` falls in.
+        '''
+        return int(timestamp) // self.index_bucket_seconds * self.index_bucket_seconds
+
+    def get_bucket(self, timestamp):
+        '''
+        Returns the index bucket, as an ISO formatted string of the bucket's
+        start, that a unix `timestamp` falls in.
+        '''
+        return time.strftime(ISO_FORMAT, time.gmtime(self.get_bucket_start(timestamp)))
+
+    def get_index_shard(self, hash_key):
+        '''
+        Returns the index shard a counter's changes are recorded in.  Each
+        bucket is spread over `index_shards` hash keys so a busy bucket
+        doesn't land on a single partition.
+        '''
+        if isinstance(hash_key, unicode):
+            hash_key = hash_key.encode('utf-8')
+
+        return (zlib.crc32(hash_key) & 0xffffffff) % self.index_shards
+
+    def get_index_hash_key(self, bucket, shard):
+        '''
+        Returns the index table hash key for a shard of a bucket.
+        '''
+        return '%s#%d' % (bucket, shard)
+
+    def get_marker_hash_key(self, bucket):
+        '''
+        Returns the index table hash key holding the markers for the UTC day
+        a bucket starts in.  Each marker records that a shard of a bucket
+        has entries, so `changed_since` can skip empty buckets and shards.
+        '''
+        return 'touched#%s' % bucket[:10]
+
+    def index_change(self, hash_key, timestamp, modified_on):
+        '''
+        Hook point for overriding how the CounterPool records that a
+        counter was modified at the unix `timestamp`.  Each counter, and
+        each shard's marker, is only written to the index once per bucket
+        by this pool.
+        '''
+        bucket = self.get_bucket(timestamp)
+
+        if bucket != self._indexed_bucket:
+            self._indexed_bucket = bucket
+            self._indexed_names = set()
+            self._marked_shards = set()
+        elif hash_key in self._indexed_names:
+            return
+
+        table = self.get_index_table()
+        shard = self.get_index_shard(hash_key)
+
+        if shard not in self._marked_shards:
+            marker = table.new_item(
+                hash_key=self.get_marker_hash_key(bucket),
+                range_key=self.get_index_hash_key(bucket, shard),
+                attrs={'index_bucket': bucket, 'index_shard': shard},
+            )
+            marker.put()
+            self._marked_shards.add(shard)
+
+        item = table.new_item(
+            hash_key=self.get_index_hash_key(bucket, shard),
+            range_key=hash_key,
+            attrs={'modified_on': modified_on},
+        )
+        item.put()
+        self._indexed_names.add(hash_key)
+
+    def get_touched_shards(self, day_start, start_bucket):
+        '''
+        Returns the sorted `(bucket, shard)` pairs with index entries for
+        the UTC day starting at the unix `day_start`, skipping buckets
+        before `start_bucket`.
+        '''
+        table = self.get_index_table()
+        day_bucket = time.strftime(ISO_FORMAT, time.gmtime(day_start))
+        markers = table.query(hash_key=self.get_marker_hash_key(day_bucket))
+        touched = [
+            (marker['index_bucket'], int(marker['index_shard']))
+            for marker in markers
+            if marker['index_bucket'] >= start_bucket
+        ]
+        touched.sort()
+
+        return touched
+
+    def changed_since(self, since, cursor=None):
+        '''
+        Generates `(name, cursor)` tuples for every counter modified at or
+        after the naive UTC datetime `since`, using the index table.
+
+        Results are bucket granular, so counters modified earlier in the
+        bucket containing `since` are included too, and a counter modified
+        in several buckets is generated once per bucket.  Only shards with
+        entries are queried, found through one marker query per UTC day,
+        so the cost follows the number of changes rather than the length
+        of the window.
+
+        Passing a generated cursor back in, along with the same `since`,
+        resumes with the counters after it.  Cursors never move past a
+        bucket until `index_close_delay` seconds after it ends, leaving
+        room for clock skew and writes still in flight; until then
+        resuming re-reads the bucket in full rather than missing changes.
+        '''
+        if not self.get_index_table_name():
+            raise NotImplementedError(
+                'You must provide an index_table_name value or override the get_index_table_name method'
+            )
+
+        table = self.get_index_table()
+        step = self.index_bucket_seconds
+        start = self.get_bucket_start(calendar.timegm(since.utctimetuple()))
+        now = time.time()
+        resume = None
+
+        if cursor is not None:
+            cursor_bucket, cursor_shard, cursor_name = cursor
+            cursor_start = calendar.timegm(time.strptime(cursor_bucket, ISO_FORMAT))
+
+            if cursor_start >= start:
+                start = cursor_start
+
+                if cursor_shard is not None:
+                    resume = (cursor_bucket, cursor_shard, cursor_name)
+
+        start_bucket = self.get_bucket(start)
+
+        for day_start in xrange(start - start % DAY_SECONDS, int(now) + 1, DAY_SECONDS):
+            for bucket, shard in self.get_touched_shards(day_start, start_bucket):
+                index_hash_key = self.get_index_hash_key(bucket, shard)
+                exclusive_start_key = None
+
+                if resume is not None:
+                    if (bucket, shard) < resume[:2]:
+                        continue
+                    elif (bucket, shard) == resume[:2]:
+                        exclusive_start_key = (index_hash_key, resume[2])
+
+                bucket_start = calendar.timegm(time.strptime(bucket, ISO_FORMAT))
+                is_open = bucket_start + step + self.index_close_delay > now
+                items = table.query(
+                    hash_key=index_hash_key,
+                    exclusive_start_key=exclusive_start_key,
+                )
+
+                for item in items:
+                    if is_open:
+                        next_cursor = (bucket, None, None)
+                    else:
+                        next_cursor = (bucket, shard, item.range_key)
+
+                    yield item.range_key, next_cursor
+
+    def prune_index(self, before):
+        '''
+        Deletes index entries and markers for buckets that ended before the
+        naive UTC datetime `before`.  The index table otherwise grows
+        without bound, so this should be run periodically with a retention
+        window longer than any reconciliation job looks back.  It scans the
+        whole index table, so the cost follows the index size.
+        '''
+        table = self.get_index_table()
+        cutoff = self.get_bucket(calendar.timegm(before.utctimetuple()))
+
+        for item in table.scan():
+            if item.hash_key.startswith('touched#'):
+                bucket = item.range_key.split('#')[0]
+            else:
+                bucket = item.hash_key.split('#')[0]
+
+            if bucket < cutoff:
+                item.delete()
+
+    def record_access(self, hash_key):
+        '''
+        Hook point for overriding how the CounterPool reports reads and
+        writes of a counter to its heavy hitter tracker.
+        '''
+        if self.heavy_hitter_tracker is not None:
+            self.heavy_hitter_tracker.record(hash_key)
+
+    def get_heavy_hitters(self, limit=None):
+        '''
+        Returns the busiest counters seen by the heavy hitter tracker as
+        `(name, rate, error)` tuples.
+        '''
+        if self.heavy_hitter_tracker is None:
+            return []
+
+        return self.heavy_hitter_tracker.heavy_hitters(limit)
 
     def create_item(self, hash_key, start=0, extra_attrs=None):
         '''
@@ -165,6 +453,7 @@ class CounterPool(object):
         for a given counter.
         '''
         table = self.get_table()
+        self.record_access(hash_key)
 
         try:
             item = table.get_item(hash_key=hash_key)
@@ -180,6 +469,21 @@ class CounterPool(object):
 
         return item
 
+    def get_item_attributes(self, hash_key, request_body):
+        '''
+        Hook point for overriding how the CounterPool fetches the current
+        attributes of a counter's item when the counter is refreshed.
+        `request_body` is the counter's pre-serialized GetItem request.
+        Returns None if the item doesn't exist.
+        '''
+        self.record_access(hash_key)
+        result = self.conn.layer1.make_request('GetItem', request_body)
+
+        if 'Item' not in result:
+            return None
+
+        return decode_attributes(result['Item'])
+
     def get_counter(self, name, start=0):
         '''
         Gets the DynamoDB item behind a counter and ties it to a Counter
@@ -199,6 +503,7 @@ class Counter(object):
     def __init__(self, dynamo_item, pool):
         self.dynamo_item = dynamo_item
         self.pool = pool
+        self._wire_templates = None
 
     @property
     def name(self):
@@ -206,7 +511,6 @@ class Counter(object):
 
     @property
     def count(self):
-        print self.dynamo_item
         return self.dynamo_item['count']
 
     @property
@@ -217,20 +521,94 @@ class Counter(object):
     def modified_on(self):
         return datetime.strptime(self.dynamo_item['modified_on'], ISO_FORMAT)
 
+    def get_wire_templates(self):
+        '''
+        Pre-serializes the parts of this counter's GetItem and UpdateItem
+        requests that never change, so each call only has to format in the
+        increment amount and timestamp.
+        '''
+        if self._wire_templates is None:
+            item = self.dynamo_item
+            table = self.pool.get_table()
+            key = self.pool.conn.build_key_from_values(
+                table.schema,
+                item.hash_key,
+                item.range_key,
+            )
+            target = '"TableName": %s, "Key": %s' % (
+                json.dumps(table.name),
+                json.dumps(key),
+            )
+            get_body = '{%s}' % target
+            update_template = (
+                '{%s, "ReturnValues": "UPDATED_NEW", "AttributeUpdates": '
+                '{"count": {"Action": "ADD", "Value": {"N": "%%s"}}, '
+                '"modified_on": {"Action": "PUT", "Value": {"S": "%%s"}}}}'
+            ) % target.replace('%', '%%')
+            self._wire_templates = (get_body, update_template)
+
+        return self._wire_templates
+
     def refresh(self):
-        self.dynamo_item = self.pool.get_item(hash_key=self.name)
+        get_body = self.get_wire_templates()[0]
+        attrs = self.pool.get_item_attributes(self.name, get_body)
+
+        if attrs is not None:
+            item = self.dynamo_item
+            item.clear()
+            item.update(attrs)
+        else:
+            self.dynamo_item = self.pool.create_item(hash_key=self.name)
+            self._wire_templates = None
 
     def increment(self, amount=1):
-        item = self.dynamo_item
-        item.add_attribute('count', amount)
-        item.put_attribute(
-            'modified_on',
-            datetime.utcnow().replace(microsecond=0).isoformat()
-        )
-        result = item.save(return_values='UPDATED_NEW')
-        item.update(result['Attributes'])
+        if isinstance(amount, bool) or not isinstance(amount, numbers.Real):
+            raise TypeError('Counter amounts must be numbers, not %r' % (amount, ))
+
+        if isinstance(amount, float) and (math.isinf(amount) or math.isnan(amount)):
+            raise ValueError('Counter amounts must be finite, not %r' % (amount, ))
+
+        update_template = self.get_wire_templates()[1]
+        now = time.time()
+        modified_on = time.strftime(ISO_FORMAT, time.gmtime(now))
+
+        if self.pool.get_index_table_name():
+            self.pool.index_change(self.name, now, modified_on)
+
+        body = update_template % (amount, modified_on)
+        self.pool.record_access(self.name)
+        result = self.pool.conn.layer1.make_request('UpdateItem', body)
+        self.dynamo_item.update(decode_attributes(result['Attributes']))
 
         return self.count
 
     def decrement(self, amount=1):
         return self.increment(amount * -1)
+
+
+def convert_num(value):
+    if '.' in value:
+        return float(value)
+
+    return int(value)
+
+
+def decode_attributes(attrs):
+    '''
+    Converts DynamoDB wire format attributes into plain Python values.
+    '''
+    decoded = {}
+
+    for name, value in attrs.items():
+        data_type, data = value.items()[0]
+
+        if data_type == 'N':
+            data = convert_num(data)
+        elif data_type == 'NS':
+            data = set(convert_num(n) for n in data)
+        elif data_type == 'SS':
+            data = set(data)
+
+        decoded[name] = data
+
+    return decoded
@@ -1,31 +1,173 @@
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+import time
+
 import boto
+from boto.regioninfo import RegionInfo
 
 from nose.tools import make_decorator
 
 from testconfig import config
 
+BATCH_SIZE = 25
+DEFAULT_WORKERS = 8
+MAX_BACKOFF = 1.0
+MAX_ATTEMPTS = 10
+
+
+def get_test_connection(aws_access_key=None, aws_secret_key=None):
+    '''
+    Connects to DynamoDB using the given credentials, or those in the test
+    config.  If a `local_host` option is set in the `albertson` section the
+    connection targets a local DynamoDB stand-in at that host (and
+    `local_port`) instead of AWS, and dummy credentials are used when none
+    are configured.
+    '''
+    options = config['albertson']
+    local_host = options.get('local_host')
+    aws = config.get('aws', {})
+    aws_access_key = aws_access_key or aws.get('access_key')
+    aws_secret_key = aws_secret_key or aws.get('secret_key')
+    kwargs = {}
+
+    if local_host:
+        aws_access_key = aws_access_key or 'local'
+        aws_secret_key = aws_secret_key or 'local'
+        kwargs.update({
+            'region': RegionInfo(name='local', endpoint=local_host),
+            'port': int(options.get('local_port') or 8000),
+            'is_secure': False,
+        })
+
+    kwargs.update({
+        'aws_access_key_id': aws_access_key,
+        'aws_secret_access_key': aws_secret_key,
+    })
+
+    return boto.connect_dynamodb(**kwargs)
+
+
+class TestConnectionMixin(object):
+    '''
+    A CounterPool mixin that connects through `get_test_connection`, so
+    pools under test honour the local DynamoDB settings in the test config.
+    '''
+    def get_conn(self, aws_access_key=None, aws_secret_key=None):
+        return get_test_connection(aws_access_key, aws_secret_key)
+
+
+def get_worker_count():
+    return int(config['albertson'].get('cleanup_workers') or DEFAULT_WORKERS)
+
+
+def chunked(iterable, size=BATCH_SIZE):
+    chunk = []
+
+    for value in iterable:
+        chunk.append(value)
+
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def batch_write(conn, table_name, requests):
+    '''
+    Sends up to 25 write requests to a table with a single BatchWriteItem
+    call, retrying any unprocessed items with a capped exponential backoff.
+    Gives up after `MAX_ATTEMPTS` calls.
+    '''
+    request_items = {table_name: requests}
+    backoff = 0.05
+
+    for attempt in xrange(MAX_ATTEMPTS):
+        result = conn.layer1.batch_write_item(request_items)
+        request_items = result.get('UnprocessedItems')
+
+        if not request_items:
+            return
+
+        time.sleep(backoff)
+        backoff = min(backoff * 2, MAX_BACKOFF)
+
+    raise RuntimeError(
+        '%d items left unprocessed in %s after %d BatchWriteItem attempts' % (
+            len(request_items.get(table_name, [])),
+            table_name,
+            MAX_ATTEMPTS,
+        )
+    )
+
+
+def parallel_batch_write(conn, table_name, requests, workers=None):
+    '''
+    Splits write requests into BatchWriteItem sized chunks and sends them
+    from a pool of threads.
+    '''
+    pool = ThreadPool(workers or get_worker_count())
+
+    try:
+        for _ in pool.imap_unordered(
+            lambda chunk: batch_write(conn, table_name, chunk),
+            chunked(requests),
+        ):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+
 
 class DynamoDeleteMixin(object):
     '''
-    A mixin that will delete the dynamodb table used by the tests at the end
-    of the test run if the delete_table option is set to "true".
+    A mixin that will delete the dynamodb table used by the tests, along with
+    any `extra_tables`, at the end of the test run if the delete_table option
+    is set to "true".
     '''
+    extra_tables = []
+
     @classmethod
     def tearDownClass(cls):
         if config['albertson']['delete_table'] in ['1', 'yes', 'true', 'on']:
-            conn = boto.connect_dynamodb(
-                aws_access_key_id=config['aws']['access_key'],
-                aws_secret_access_key=config['aws']['secret_key'],
-            )
-            table = conn.get_table(config['albertson']['test_table_name'])
-            table.delete()
-
-
-def dynamo_cleanup_func(extra_tables=None):
-    conn = boto.connect_dynamodb(
-        aws_access_key_id=config['aws']['access_key'],
-        aws_secret_access_key=config['aws']['secret_key'],
-    )
+            conn = get_test_connection()
+            table_names = [config['albertson']['test_table_name']] + list(cls.extra_tables)
+
+            for table_name in table_names:
+                try:
+                    table = conn.get_table(table_name)
+                except boto.exception.DynamoDBResponseError:
+                    continue
+
+                table.delete()
+
+
+def dynamo_load_counters(counters, table_name=None, workers=None):
+    '''
+    Seeds a table with counters in bulk.  `counters` maps counter names to
+    their starting counts.
+    '''
+    conn = get_test_connection()
+    table = conn.get_table(table_name or config['albertson']['test_table_name'])
+    hash_key_name = table.schema.hash_key_name
+    now = datetime.utcnow().replace(microsecond=0).isoformat()
+
+    def put_requests():
+        for name, count in counters.items():
+            attrs = {
+                hash_key_name: name,
+                'created_on': now,
+                'modified_on': now,
+                'count': count,
+            }
+            yield {'PutRequest': {'Item': conn.dynamize_item(attrs)}}
+
+    parallel_batch_write(conn, table.name, put_requests(), workers)
+
+
+def dynamo_cleanup_func(extra_tables=None, workers=None):
+    conn = get_test_connection()
     tables = [config['albertson']['test_table_name']]
 
     if extra_tables:
@@ -38,10 +180,18 @@ def dynamo_cleanup_func(extra_tables=None):
             table = None
 
         if table:
-            items = table.scan()
+            schema = table.schema
+            key_names = [schema.hash_key_name]
+
+            if schema.range_key_name:
+                key_names.append(schema.range_key_name)
+
+            def delete_requests():
+                for item in table.scan(attributes_to_get=key_names):
+                    key = conn.build_key_from_values(schema, item.hash_key, item.range_key)
+                    yield {'DeleteRequest': {'Key': key}}
 
-            for item in items:
-                item.delete()
+            parallel_batch_write(conn, table.name, delete_requests(), workers)
 
 
 def dynamo_cleanup(extra_tables=None):
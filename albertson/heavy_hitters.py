@@ -0,0 +1,212 @@
+import heapq
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class HeavyHitterTracker(object):
+    '''
+    Bounded memory, streaming, top-K tracker for counter traffic.
+
+    Uses the Space-Saving algorithm: at most `capacity` counter names are
+    tracked at once and when a new name arrives while full it replaces the
+    least active name, inheriting its count as the error bound.  Any name
+    whose true share of traffic exceeds 1 / `capacity` is guaranteed to be
+    tracked.  The least active name is found with a lazily pruned min-heap,
+    so eviction costs O(log capacity).
+
+    Rates are estimated over a sliding window made of two tumbling windows:
+    the previous window's counts are carried forward, weighted by how much
+    of it still overlaps the trailing `window` seconds.  A key running
+    steadily above the threshold therefore stays hot across window
+    boundaries instead of resetting each time one ends.
+    '''
+    capacity = 100
+    window = 60
+    threshold = None
+
+    def __init__(self, capacity=None, window=None, threshold=None, callback=None, clock=time.time):
+        """
+        :capacity:
+            Maximum number of counter names to track at once.
+        :window:
+            Length, in seconds, of the sliding window rates are estimated
+            over.  Counts older than two windows are dropped.
+        :threshold:
+            Estimated rate, in operations per second, above which a counter
+            name is considered hot.  A name crosses the threshold once its
+            guaranteed count over the sliding window, excluding any count
+            inherited through eviction, reaches `threshold * window`.
+        :callback:
+            Called as `callback(name, rate)` when a name crosses the
+            threshold.  It isn't called again while the name stays hot.
+        :clock:
+            Callable returning the current time in seconds.
+        """
+        self.capacity = capacity or self.capacity
+        self.window = window or self.window
+        self.threshold = threshold or self.threshold
+        self.callback = callback
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.reset()
+
+        super(HeavyHitterTracker, self).__init__()
+
+    def reset(self):
+        '''
+        Drops all tracked counts, including the previous window's, and
+        starts a new window.
+        '''
+        self._start_window(self.clock(), {}, {}, has_history=False)
+
+    def _start_window(self, start, previous_counts, previous_errors, has_history=True):
+        self._has_history = has_history
+        self._previous_counts = previous_counts
+        self._previous_errors = previous_errors
+        self._counts = {}
+        self._errors = {}
+        self._heap = []
+        self._window_start = start
+        self._fired = set(
+            name for name in previous_counts
+            if self._is_over_threshold(name, start)
+        )
+
+    def _expire_window(self):
+        elapsed = self.clock() - self._window_start
+
+        if elapsed < self.window:
+            return
+
+        windows = int(elapsed // self.window)
+
+        if windows == 1:
+            self._start_window(self._window_start + self.window, self._counts, self._errors)
+        else:
+            self._start_window(self._window_start + windows * self.window, {}, {})
+
+    def _estimate(self, name, now):
+        '''
+        Returns the `(count, error)` estimate for `name` over the trailing
+        window, weighting the previous window by how much of it still
+        overlaps.
+        '''
+        carry = 1 - (now - self._window_start) / float(self.window)
+        count = self._counts.get(name, 0) + self._previous_counts.get(name, 0) * carry
+        error = self._errors.get(name, 0) + self._previous_errors.get(name, 0) * carry
+
+        return count, error
+
+    def _is_over_threshold(self, name, now):
+        if not self.threshold:
+            return False
+
+        count, error = self._estimate(name, now)
+
+        return count - error >= self.threshold * self.window
+
+    def _pop_least_active(self):
+        counts = self._counts
+
+        while True:
+            count, name = heapq.heappop(self._heap)
+
+            if counts.get(name) == count:
+                return name
+
+    def _compact_heap(self):
+        self._heap = [(count, name) for name, count in self._counts.items()]
+        heapq.heapify(self._heap)
+
+    def record(self, name, weight=1):
+        '''
+        Records `weight` operations against the counter called `name`.
+        Exceptions raised by the callback are logged rather than raised, so
+        tracking can never break the caller.
+        '''
+        fire = False
+
+        with self._lock:
+            self._expire_window()
+            counts = self._counts
+
+            if name in counts:
+                counts[name] += weight
+            elif len(counts) < self.capacity:
+                counts[name] = weight
+                self._errors[name] = 0
+            else:
+                evicted = self._pop_least_active()
+                floor = counts.pop(evicted)
+                del self._errors[evicted]
+                self._fired.discard(evicted)
+                counts[name] = floor + weight
+                self._errors[name] = floor
+
+            heapq.heappush(self._heap, (counts[name], name))
+
+            if len(self._heap) > 2 * self.capacity:
+                self._compact_heap()
+
+            now = self.clock()
+
+            if name not in self._fired and self._is_over_threshold(name, now):
+                self._fired.add(name)
+                count, error = self._estimate(name, now)
+                rate = self._get_rate(count - error, now)
+                fire = True
+
+        if fire and self.callback:
+            try:
+                self.callback(name, rate)
+            except Exception:
+                logger.exception('Heavy hitter callback failed for %r', name)
+
+    def _get_rate(self, count, now):
+        if self._has_history:
+            covered = self.window
+        else:
+            covered = max(now - self._window_start, 1)
+
+        return float(count) / covered
+
+    def get_rate(self, count):
+        '''
+        Converts a count over the trailing window into operations per
+        second.
+        '''
+        return self._get_rate(count, self.clock())
+
+    def heavy_hitters(self, limit=None):
+        '''
+        Returns a list of `(name, rate, error)` tuples for the most active
+        counters over the trailing window, busiest first.  `rate` is an
+        upper bound on the true rate and `rate - error` a lower bound.
+        '''
+        with self._lock:
+            self._expire_window()
+            now = self.clock()
+            names = set(self._counts) | set(self._previous_counts)
+            estimates = [(name, self._estimate(name, now)) for name in names]
+            estimates.sort(key=lambda pair: pair[1][0], reverse=True)
+
+            if limit is not None:
+                estimates = estimates[:limit]
+
+            return [
+                (name, self._get_rate(count, now), self._get_rate(error, now))
+                for name, (count, error) in estimates
+            ]
+
+    def is_hot(self, name):
+        '''
+        Is the guaranteed rate of `name` over the trailing window above the
+        threshold.
+        '''
+        with self._lock:
+            self._expire_window()
+
+            return self._is_over_threshold(name, self.clock())
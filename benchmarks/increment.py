@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+'''
+Measures the client side CPU time spent per Counter.increment call.
+
+DynamoDB is never contacted: the connection's make_request is replaced with
+one that returns a canned UpdateItem response, so the numbers only cover
+request building, serialization, and response handling.
+
+Usage: python benchmarks/increment.py [iterations]
+'''
+from datetime import datetime
+import json
+import sys
+import time
+
+from albertson import Counter, CounterPool
+
+UPDATE_RESPONSE = json.dumps({
+    'Attributes': {
+        'count': {'N': '6'},
+        'modified_on': {'S': '2012-01-02T23:32:13'},
+    },
+    'ConsumedCapacityUnits': 1.0,
+})
+
+
+def canned_make_request(action, body='', object_hook=None):
+    return json.loads(UPDATE_RESPONSE, object_hook=object_hook)
+
+
+def item_increment(counter, amount=1):
+    '''
+    The Layer2 Item based increment that Counter.increment replaced.
+    '''
+    item = counter.dynamo_item
+    item.add_attribute('count', amount)
+    item.put_attribute(
+        'modified_on',
+        datetime.utcnow().replace(microsecond=0).isoformat()
+    )
+    result = item.save(return_values='UPDATED_NEW')
+    item.update(result['Attributes'])
+
+    return counter.count
+
+
+def wire_increment(counter, amount=1):
+    return counter.increment(amount)
+
+
+def get_counter():
+    pool = CounterPool(
+        aws_access_key='benchmark',
+        aws_secret_key='benchmark',
+        table_name='albertson_benchmark',
+    )
+    pool.conn.layer1.make_request = canned_make_request
+    schema = pool.get_schema()
+    pool._table = pool.conn.table_from_schema(pool.get_table_name(), schema)
+    item = pool.create_item(hash_key='benchmark')
+
+    return Counter(dynamo_item=item, pool=pool)
+
+
+def run(func, iterations):
+    counter = get_counter()
+    start = time.clock()
+
+    for _ in xrange(iterations):
+        func(counter)
+
+    return (time.clock() - start) / iterations
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    for label, func in [('item', item_increment), ('wire', wire_increment)]:
+        per_op = run(func, iterations)
+        print '%-5s %8.2f us/op' % (label, per_op * 1000000)
+
+
+if __name__ == '__main__':
+    main()
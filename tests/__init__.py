@@ -1 +1,2 @@
 from .base import *
+from .heavy_hitters import *
@@ -1,4 +1,5 @@
 from datetime import datetime
+import time
 import unittest
 
 import boto
@@ -8,13 +9,25 @@ from mock import MagicMock, sentinel
 
 from testconfig import config
 
-from albertson import CounterPool
-from albertson.dynamodb_utils.testing import dynamo_cleanup, DynamoDeleteMixin
+from albertson import Counter, CounterPool
+from albertson.base import decode_attributes
+from albertson.dynamodb_utils.testing import dynamo_cleanup, dynamo_cleanup_func, dynamo_load_counters, get_test_connection, DynamoDeleteMixin, TestConnectionMixin
 
 ISO_FORMAT = '%Y-%m-%dT%H:%M:%S'
+INDEX_TABLE_NAME = 'albertson_test_index'
+INDEX_SCHEMA_KWARGS = {
+    'hash_key_name': 'bucket',
+    'range_key_name': 'counter_name',
+    'range_key_proto_value': 'S',
+}
+
+
+class TestingCounterPool(TestConnectionMixin, CounterPool):
+    pass
 
 
 class BaseCounterPoolTests(DynamoDeleteMixin, unittest.TestCase):
+    extra_tables = [INDEX_TABLE_NAME]
 
     def __init__(self, *args, **kwargs):
         self.tables = {}
@@ -25,10 +38,7 @@ class BaseCounterPoolTests(DynamoDeleteMixin, unittest.TestCase):
         conn = getattr(self, '_conn', None)
 
         if not conn:
-            conn = boto.connect_dynamodb(
-                aws_access_key_id=config['aws']['access_key'],
-                aws_secret_access_key=config['aws']['secret_key'],
-            )
+            conn = get_test_connection()
             self._conn = conn
 
         return conn
@@ -81,10 +91,10 @@ class BaseCounterPoolTests(DynamoDeleteMixin, unittest.TestCase):
         return table
 
     def get_pool(self, pool_class=None, **kwargs):
-        pool_class = pool_class or CounterPool
+        pool_class = pool_class or TestingCounterPool
         real_kwargs = {
-            'aws_access_key': config['aws']['access_key'],
-            'aws_secret_key': config['aws']['secret_key'],
+            'aws_access_key': config.get('aws', {}).get('access_key'),
+            'aws_secret_key': config.get('aws', {}).get('secret_key'),
             'table_name': config['albertson']['test_table_name'],
             'auto_create_table': False,
         }
@@ -130,7 +140,7 @@ class BaseCounterPoolTests(DynamoDeleteMixin, unittest.TestCase):
             pool.get_table_name()
 
     def test_get_attr_table_name(self):
-        class TestCounterPool(CounterPool):
+        class TestCounterPool(TestingCounterPool):
             table_name = 'some_name'
 
         pool = self.get_pool(pool_class=TestCounterPool, table_name=None)
@@ -299,6 +309,29 @@ class BaseCounterPoolTests(DynamoDeleteMixin, unittest.TestCase):
 
         self.assertEqual(expected, result)
 
+    @dynamo_cleanup()
+    def test_load_counters(self):
+        table = self.get_table()
+        counters = dict(('load-%d' % i, i) for i in range(60))
+
+        dynamo_load_counters(counters)
+
+        result = dict(
+            (item['counter_name'], item['count'])
+            for item in table.scan()
+        )
+
+        self.assertEqual(counters, result)
+
+    @dynamo_cleanup()
+    def test_cleanup_func(self):
+        table = self.get_table()
+        dynamo_load_counters(dict(('cleanup-%d' % i, i) for i in range(60)))
+
+        dynamo_cleanup_func()
+
+        self.assertEqual([], list(table.scan()))
+
     @dynamo_cleanup()
     def test_get_counter(self):
         pool = self.get_pool()
@@ -308,6 +341,40 @@ class BaseCounterPoolTests(DynamoDeleteMixin, unittest.TestCase):
 
         self.assertEqual(pool, result.pool)
 
+    @dynamo_cleanup()
+    def test_get_counter_records_access(self):
+        tracker = MagicMock(name='heavy_hitter_tracker')
+        pool = self.get_pool(heavy_hitter_tracker=tracker)
+        name = 'test'
+
+        counter = pool.get_counter(name)
+        counter.increment()
+
+        self.assertEqual(2, tracker.record.call_count)
+        tracker.record.assert_called_with(name)
+
+    @dynamo_cleanup()
+    def test_throttled_increment_records_access(self):
+        tracker = MagicMock(name='heavy_hitter_tracker')
+        pool = self.get_pool(heavy_hitter_tracker=tracker)
+        name = 'test'
+        counter = pool.get_counter(name)
+        tracker.reset_mock()
+        pool.conn.layer1.make_request = MagicMock(
+            name='make_request',
+            side_effect=boto.exception.DynamoDBResponseError(400, 'ProvisionedThroughputExceededException'),
+        )
+
+        with self.assertRaises(boto.exception.DynamoDBResponseError):
+            counter.increment()
+
+        tracker.record.assert_called_once_with(name)
+
+    def test_get_heavy_hitters_without_tracker(self):
+        pool = self.get_pool()
+
+        self.assertEqual([], pool.get_heavy_hitters())
+
     @dynamo_cleanup()
     def test_counter_name(self):
 
@@ -350,6 +417,167 @@ class BaseCounterPoolTests(DynamoDeleteMixin, unittest.TestCase):
 
         self.assertEquals(expected, result)
 
+    def test_get_bucket(self):
+        pool = self.get_pool(index_bucket_seconds=3600)
+
+        expected = '2012-01-02T23:00:00'
+        result = pool.get_bucket(1325547133)
+
+        self.assertEqual(expected, result)
+
+    def test_changed_since_without_index(self):
+        pool = self.get_pool()
+
+        with self.assertRaises(NotImplementedError):
+            list(pool.changed_since(datetime.utcnow()))
+
+    @dynamo_cleanup(extra_tables=[INDEX_TABLE_NAME])
+    def test_changed_since(self):
+        self.get_table(INDEX_TABLE_NAME, schema_kwargs=INDEX_SCHEMA_KWARGS)
+        pool = self.get_pool(index_table_name=INDEX_TABLE_NAME)
+        since = datetime.utcnow()
+
+        for name in ['a', 'b', 'c']:
+            pool.get_counter(name).increment()
+
+        result = sorted(name for name, cursor in pool.changed_since(since))
+
+        self.assertEqual(['a', 'b', 'c'], result)
+
+    @dynamo_cleanup(extra_tables=[INDEX_TABLE_NAME])
+    def test_changed_since_resumes_open_bucket(self):
+        self.get_table(INDEX_TABLE_NAME, schema_kwargs=INDEX_SCHEMA_KWARGS)
+        pool = self.get_pool(index_table_name=INDEX_TABLE_NAME)
+        since = datetime.utcnow()
+
+        for name in ['b', 'c']:
+            pool.get_counter(name).increment()
+
+        cursor = list(pool.changed_since(since))[-1][1]
+
+        pool.get_counter('a').increment()
+        pool.get_counter('b').increment()
+
+        result = sorted(name for name, cursor in pool.changed_since(since, cursor))
+
+        self.assertEqual(['a', 'b', 'c'], result)
+
+    @dynamo_cleanup(extra_tables=[INDEX_TABLE_NAME])
+    def test_changed_since_resumes_closed_bucket(self):
+        self.get_table(INDEX_TABLE_NAME, schema_kwargs=INDEX_SCHEMA_KWARGS)
+        pool = self.get_pool(
+            index_table_name=INDEX_TABLE_NAME,
+            index_bucket_seconds=1,
+            index_close_delay=0,
+        )
+        since = datetime.utcnow()
+
+        for name in ['a', 'b', 'c']:
+            pool.get_counter(name).increment()
+
+        time.sleep(2)
+        changes = list(pool.changed_since(since))
+
+        expected = [name for name, cursor in changes[1:]]
+        result = [name for name, cursor in pool.changed_since(since, changes[0][1])]
+
+        self.assertEqual(expected, result)
+
+    @dynamo_cleanup(extra_tables=[INDEX_TABLE_NAME])
+    def test_index_change_once_per_bucket(self):
+        self.get_table(INDEX_TABLE_NAME, schema_kwargs=INDEX_SCHEMA_KWARGS)
+        pool = self.get_pool(index_table_name=INDEX_TABLE_NAME)
+        pool._index_table = MagicMock(name='index_table')
+
+        for _ in range(3):
+            pool.get_counter('a').increment()
+
+        # One shard marker and one index entry.
+        self.assertEqual(2, pool._index_table.new_item.call_count)
+
+    @dynamo_cleanup(extra_tables=[INDEX_TABLE_NAME])
+    def test_changed_since_sees_late_writes(self):
+        self.get_table(INDEX_TABLE_NAME, schema_kwargs=INDEX_SCHEMA_KWARGS)
+        pool_kwargs = {
+            'index_table_name': INDEX_TABLE_NAME,
+            'index_bucket_seconds': 1,
+            'index_close_delay': 30,
+        }
+        pool = self.get_pool(**pool_kwargs)
+        since = datetime.utcnow()
+        written_at = time.time()
+
+        pool.index_change('b', written_at, since.replace(microsecond=0).isoformat())
+        time.sleep(2)
+        cursor = list(pool.changed_since(since))[-1][1]
+
+        late_pool = self.get_pool(**pool_kwargs)
+        late_pool.index_change('a', written_at, since.replace(microsecond=0).isoformat())
+
+        result = sorted(name for name, cursor in pool.changed_since(since, cursor))
+
+        self.assertEqual(['a', 'b'], result)
+
+    @dynamo_cleanup(extra_tables=[INDEX_TABLE_NAME])
+    def test_changed_since_skips_untouched_shards(self):
+        self.get_table(INDEX_TABLE_NAME, schema_kwargs=INDEX_SCHEMA_KWARGS)
+        pool = self.get_pool(index_table_name=INDEX_TABLE_NAME)
+        pool.get_counter('a').increment()
+        index_table = pool.get_index_table()
+        pool._index_table = MagicMock(name='index_table', wraps=index_table)
+
+        result = [name for name, cursor in pool.changed_since(datetime.utcnow())]
+
+        self.assertEqual(['a'], result)
+        # One marker query for the day and one for the touched shard.
+        self.assertEqual(2, pool._index_table.query.call_count)
+
+    @dynamo_cleanup(extra_tables=[INDEX_TABLE_NAME])
+    def test_prune_index(self):
+        index_table = self.get_table(INDEX_TABLE_NAME, schema_kwargs=INDEX_SCHEMA_KWARGS)
+        pool = self.get_pool(index_table_name=INDEX_TABLE_NAME, index_bucket_seconds=1)
+        since = datetime.utcnow()
+        pool.get_counter('a').increment()
+        time.sleep(2)
+
+        pool.prune_index(datetime.utcnow())
+
+        self.assertEqual([], list(index_table.scan()))
+        self.assertEqual([], list(pool.changed_since(since)))
+
+    def test_increment_rejects_non_numbers(self):
+        pool = MagicMock(name='pool')
+        counter = Counter(dynamo_item=MagicMock(name='dynamo_item'), pool=pool)
+
+        for amount in ['1', '1}, "x": {"Action": "PUT"', True, None, 1j]:
+            with self.assertRaises(TypeError):
+                counter.increment(amount)
+
+        with self.assertRaises(ValueError):
+            counter.increment(float('nan'))
+
+        self.assertFalse(pool.conn.layer1.make_request.called)
+
+    def test_decode_attributes(self):
+        attrs = {
+            'count': {'N': '5'},
+            'rate': {'N': '0.5'},
+            'modified_on': {'S': '2012-01-02T23:32:13'},
+            'tags': {'SS': ['a', 'b']},
+            'sizes': {'NS': ['1', '2']},
+        }
+
+        expected = {
+            'count': 5,
+            'rate': 0.5,
+            'modified_on': '2012-01-02T23:32:13',
+            'tags': set(['a', 'b']),
+            'sizes': set([1, 2]),
+        }
+        result = decode_attributes(attrs)
+
+        self.assertEqual(expected, result)
+
     @dynamo_cleanup()
     def test_counter_refresh(self):
         pool = self.get_pool()
@@ -366,6 +594,32 @@ class BaseCounterPoolTests(DynamoDeleteMixin, unittest.TestCase):
 
         self.assertEqual(expected, counter.dynamo_item)
 
+    @dynamo_cleanup()
+    def test_counter_refresh_hook(self):
+        tracker = MagicMock(name='heavy_hitter_tracker')
+        pool = self.get_pool(heavy_hitter_tracker=tracker)
+        item = self.get_item()
+        counter = pool.get_counter(item.hash_key)
+        pool.get_item_attributes = MagicMock(name='get_item_attributes')
+        pool.get_item_attributes.return_value = {'counter_name': item.hash_key, 'count': 42}
+
+        counter.refresh()
+
+        self.assertEqual(1, pool.get_item_attributes.call_count)
+        self.assertEqual(42, counter.count)
+
+    @dynamo_cleanup()
+    def test_counter_refresh_missing_item(self):
+        tracker = MagicMock(name='heavy_hitter_tracker')
+        pool = self.get_pool(heavy_hitter_tracker=tracker)
+        counter = pool.get_counter('test')
+        tracker.reset_mock()
+
+        counter.refresh()
+
+        self.assertEqual(1, tracker.record.call_count)
+        self.assertEqual(0, counter.count)
+
     @dynamo_cleanup()
     def test_counter_increment(self):
         table = self.get_table()
@@ -0,0 +1,164 @@
+import unittest
+
+from mock import MagicMock
+
+from albertson import HeavyHitterTracker
+
+
+class FakeClock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class HeavyHitterTrackerTests(unittest.TestCase):
+
+    def get_tracker(self, **kwargs):
+        real_kwargs = {
+            'capacity': 3,
+            'window': 10,
+            'clock': FakeClock(),
+        }
+        real_kwargs.update(kwargs)
+
+        return HeavyHitterTracker(**real_kwargs)
+
+    def test_record(self):
+        tracker = self.get_tracker()
+
+        for name in ['a', 'a', 'a', 'b']:
+            tracker.record(name)
+        tracker.clock.now += 2
+
+        expected = [('a', 1.5, 0.0), ('b', 0.5, 0.0)]
+        result = tracker.heavy_hitters()
+
+        self.assertEquals(expected, result)
+
+    def test_heavy_hitters_limit(self):
+        tracker = self.get_tracker()
+
+        for name in ['a', 'a', 'b', 'c']:
+            tracker.record(name)
+
+        expected = ['a']
+        result = [name for name, rate, error in tracker.heavy_hitters(1)]
+
+        self.assertEquals(expected, result)
+
+    def test_eviction_keeps_capacity(self):
+        tracker = self.get_tracker()
+
+        for name in ['a', 'a', 'a', 'b', 'b', 'c', 'd']:
+            tracker.record(name)
+
+        result = dict((name, error) for name, rate, error in tracker.heavy_hitters())
+
+        self.assertEquals(3, len(result))
+        self.assertNotIn('c', result)
+        self.assertEquals(1.0, result['d'])
+
+    def test_window_carries_previous_counts(self):
+        tracker = self.get_tracker()
+
+        tracker.record('a')
+        tracker.record('a')
+        tracker.clock.now += 15
+        tracker.record('b')
+
+        expected = [('a', 0.1, 0.0), ('b', 0.1, 0.0)]
+        result = sorted(tracker.heavy_hitters())
+
+        self.assertEquals(expected, result)
+
+    def test_window_reset(self):
+        tracker = self.get_tracker()
+
+        tracker.record('a')
+        tracker.clock.now += 20
+        tracker.record('b')
+
+        expected = ['b']
+        result = [name for name, rate, error in tracker.heavy_hitters()]
+
+        self.assertEquals(expected, result)
+
+    def test_threshold_callback(self):
+        callback = MagicMock(name='callback')
+        tracker = self.get_tracker(threshold=0.2, callback=callback)
+
+        tracker.record('a')
+        self.assertFalse(callback.called)
+        self.assertFalse(tracker.is_hot('a'))
+
+        tracker.record('a')
+        tracker.record('a')
+
+        callback.assert_called_once_with('a', 2.0)
+        self.assertTrue(tracker.is_hot('a'))
+
+    def test_threshold_ignores_inherited_counts(self):
+        callback = MagicMock(name='callback')
+        tracker = self.get_tracker(threshold=1, callback=callback)
+
+        for name in ['a', 'b', 'c']:
+            for _ in range(20):
+                tracker.record(name)
+
+        self.assertEqual(3, callback.call_count)
+        callback.reset_mock()
+
+        for name in ['x', 'y', 'z', 'w']:
+            tracker.record(name)
+
+        self.assertFalse(callback.called)
+        self.assertFalse(tracker.is_hot('w'))
+
+    def test_eviction_with_many_names(self):
+        tracker = self.get_tracker()
+
+        for i in range(100):
+            tracker.record('hot')
+            tracker.record('cold-%d' % i)
+
+        result = dict((name, rate) for name, rate, error in tracker.heavy_hitters())
+
+        self.assertEqual(3, len(result))
+        self.assertIn('hot', result)
+        self.assertLessEqual(len(tracker._heap), 2 * tracker.capacity)
+
+    def test_is_hot_expires_with_window(self):
+        tracker = self.get_tracker(threshold=0.1)
+
+        tracker.record('a')
+        self.assertTrue(tracker.is_hot('a'))
+
+        tracker.clock.now += 20
+
+        self.assertFalse(tracker.is_hot('a'))
+
+    def test_steady_key_stays_hot_across_windows(self):
+        callback = MagicMock(name='callback')
+        tracker = self.get_tracker(threshold=1, callback=callback)
+
+        for second in range(40):
+            tracker.clock.now = 1000.0 + second
+            tracker.record('a')
+            tracker.record('a')
+
+            if second >= 5:
+                self.assertTrue(tracker.is_hot('a'))
+
+        self.assertEqual(1, callback.call_count)
+
+    def test_callback_errors_are_swallowed(self):
+        callback = MagicMock(name='callback', side_effect=ValueError)
+        tracker = self.get_tracker(threshold=0.1, callback=callback)
+
+        tracker.record('a')
+
+        self.assertTrue(callback.called)
+        self.assertTrue(tracker.is_hot('a'))